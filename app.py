@@ -1,50 +1,124 @@
 import os
+import atexit
+import queue
 import logging
+import asyncio
+import threading
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime, time as dt_time, timedelta # Added for daily filtering
-import pytz
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import zip_longest
+from time import monotonic
+from zoneinfo import ZoneInfo
+from urllib.parse import urlsplit
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler
 from schedules import go_schedule, return_schedule
-from pymongo import MongoClient, errors
-import asyncio
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+from bson import ObjectId
+from pymongo import MongoClient, UpdateOne, errors
+# Set up logging: records go through a queue to a background listener thread,
+# so stream I/O never blocks the event loop
+_log_queue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+_log_queue_handler = QueueHandler(_log_queue)
+_log_queue_handler.setFormatter(logging.Formatter('%(message)s')) # Final layout is applied by the listener
+# Verbosity comes from LOG_LEVEL (e.g. WARNING in production); per-request traces are DEBUG.
+# An unknown name falls back to INFO instead of failing at import.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+_log_level_valid = isinstance(logging.getLevelName(LOG_LEVEL), int) # Known names map to their number
+logging.basicConfig(level=LOG_LEVEL if _log_level_valid else logging.INFO, handlers=[_log_queue_handler])
+_log_listener = QueueListener(_log_queue, _log_stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
+if not _log_level_valid:
+    logger.warning("⚠️ Unknown LOG_LEVEL %r, using INFO", LOG_LEVEL)
 # Set Algerian time zone
-ALGERIA_TZ = pytz.timezone('Africa/Algiers')
+ALGERIA_TZ = ZoneInfo('Africa/Algiers')
+_ONE_DAY = timedelta(days=1)
 # Constants
 DIRECTION_GO = "go"
 DIRECTION_RETURN = "return"
 # --- Define the desired time format (hour:minute only) ---
 REPORT_TIME_FORMAT = '%H:%M' # This format excludes date and seconds
+# How many of a user's own reports the delete listing shows
+USER_REPORTS_LIMIT = 15
+# How many minute groups the station report view shows
+STATION_VIEW_MINUTES = 10
+# --- Fixed reply texts (built once, reused by every handler) ---
+TEXT_WELCOME = "👋 مرحبًا بك! اختر خيارًا:"
+TEXT_BACK = "⬅️ العودة"
+TEXT_PICK_ACTION = "اختر إجراء:"
+TEXT_PICK_STATION = "📍 اختر محطتك:"
+TEXT_PICK_REPORT_STATION = "📍 اختر المحطة التي وصل إليها القطار:"
+TEXT_PICK_VIEW_DIRECTION = "🧭 اختر الاتجاه أولاً لعرض التقارير:"
+TEXT_NO_USER_REPORTS = "❌ لم تقم بإنشاء أي تقارير بعد."
+TEXT_NO_REPORTS_TODAY = "❌ لا توجد تقارير محفوظة لهذا اليوم في هذا الاتجاه."
+TEXT_DB_UNAVAILABLE = "❌ قاعدة البيانات غير متوفرة حالياً."
+TEXT_UNKNOWN_COMMAND = "❗ أمر غير معروف."
+TEXT_GENERIC_ERROR = "❌ حدث خطأ، يرجى المحاولة مرة أخرى."
+# Schedule reply templates (prefilled per direction and station further down)
+TEXT_NEXT_TRAIN_PREFIX = "🚉 القطار الآتي من {station} إلى {destination} ينطلق على الساعة "
+TEXT_ALL_TRAINS_HEADER = "جميع القطارات القادمة من {station} إلى {destination}:\n"
+TEXT_NO_TRAINS_LEFT = "❌ لا يوجد قطارات متبقية اليوم من {station} إلى {destination}."
+# Display label per direction
+DIRECTION_LABELS = {
+    DIRECTION_GO: "الجزائر الى العفرون",
+    DIRECTION_RETURN: "العفرون الى الجزائر",
+}
+# Terminal station each direction heads to
+DESTINATIONS = {
+    DIRECTION_GO: "العفرون",
+    DIRECTION_RETURN: "الجزائر",
+}
+# Shared "back to main menu" button (never mutated, safe to reuse in every keyboard)
+BACK_BUTTON = InlineKeyboardButton(TEXT_BACK, callback_data="back_to_start")
 
 # MongoDB setup
 MONGODB_URI = os.getenv("MONGODB_URI")
 DB_NAME = "train_bot"
 COLLECTION_NAME = "reports"
+# Per-day, per-direction, per-station counters maintained on every write
+STATS_COLLECTION_NAME = "daily_stats"
+# Only today's reports are ever shown; MongoDB's TTL monitor removes anything older than two days
+REPORT_RETENTION_SECONDS = 2 * 24 * 60 * 60
 # Initialize MongoDB client with error handling
 client = None
 reports_collection = None
+stats_collection = None
 MONGO_AVAILABLE = False
 def init_mongodb():
-    global client, reports_collection, MONGO_AVAILABLE
+    global client, reports_collection, stats_collection, MONGO_AVAILABLE
     logger.info("🔧 Starting MongoDB initialization...")
     if not MONGODB_URI:
         logger.error("❌ MONGODB_URI environment variable not set")
         return False
     try:
-        logger.info(f"🔧 Attempting to connect to MongoDB...")
-        logger.info(f"🔗 URI: {MONGODB_URI[:30]}...{MONGODB_URI[-20:] if len(MONGODB_URI) > 50 else MONGODB_URI}")
-        logger.info(f"MONGODB_URI is: {MONGODB_URI}")
+        # Only the host is logged: the URI carries credentials
+        logger.info("🔧 Attempting to connect to MongoDB (host=%s)...", urlsplit(MONGODB_URI).hostname)
         # Create client with timeout settings
         client = MongoClient(
             MONGODB_URI,
             serverSelectionTimeoutMS=5000,
             connectTimeoutMS=5000,
-            socketTimeoutMS=5000
+            socketTimeoutMS=5000,
+            # Bounded pool shared by the worker threads running DB calls; a few sockets are
+            # kept warm so the first requests after startup or idle skip the TCP/TLS handshake
+            maxPoolSize=50,
+            minPoolSize=5,
+            # Fail fast instead of queueing behind an exhausted pool
+            waitQueueTimeoutMS=2000,
+            heartbeatFrequencyMS=10000,
+            # Compress wire traffic (zstd via pymongo[zstd], zlib as the built-in fallback)
+            compressors="zstd,zlib",
+            retryReads=True,
+            retryWrites=True,
+            # Report timestamps are BSON dates; decode them as aware Algeria-time datetimes
+            tz_aware=True,
+            tzinfo=ALGERIA_TZ
         )
         # Test the connection
         logger.info("🔍 Testing MongoDB connection...")
@@ -53,19 +127,24 @@ def init_mongodb():
         # Access database and collection
         db = client[DB_NAME]
         reports_collection = db[COLLECTION_NAME]
+        stats_collection = db[STATS_COLLECTION_NAME]
         logger.info(f"📚 Using database: {DB_NAME}, collection: {COLLECTION_NAME}")
-        # Test insert to verify everything works
-        test_doc = {
-            "test": "connection",
-            "time": datetime.now().timestamp(),
-            "source": "bot_initialization"
-        }
-        logger.info("📝 Testing document insertion...")
-        result = reports_collection.insert_one(test_doc)
-        logger.info(f"✅ Test document inserted with ID: {result.inserted_id}")
-        # Clean up test document
-        reports_collection.delete_one({"_id": result.inserted_id})
-        logger.info("🧹 Test document cleaned up")
+        # Optional write self-test (MONGODB_SELFTEST=1); the ping above is enough in production
+        if os.getenv("MONGODB_SELFTEST") == "1":
+            test_doc = {
+                "test": "connection",
+                "time": datetime.now().timestamp(),
+                "source": "bot_initialization"
+            }
+            logger.info("📝 Testing document insertion...")
+            result = reports_collection.insert_one(test_doc)
+            logger.info(f"✅ Test document inserted with ID: {result.inserted_id}")
+            # Clean up test document
+            reports_collection.delete_one({"_id": result.inserted_id})
+            logger.info("🧹 Test document cleaned up")
+        migrate_float_timestamps()
+        ensure_indexes()
+        rebuild_daily_stats()
         MONGO_AVAILABLE = True
         logger.info("🎉 MongoDB initialization completed successfully")
         return True
@@ -82,139 +161,425 @@ def init_mongodb():
         logger.error(f"❌ MongoDB authentication failed: {e}")
         logger.error("💡 Check your username and password")
     except Exception as e:
-        logger.error(f"❌ Unexpected error during MongoDB initialization: {e}")
-        logger.exception(e)
+        logger.exception("❌ Unexpected error during MongoDB initialization: %s", e)
     return False
-# Initialize MongoDB on startup
-logger.info("🚀 Initializing MongoDB connection...")
-MONGO_AVAILABLE = init_mongodb()
-logger.info(f"📊 MongoDB Status: {'🟢 Available' if MONGO_AVAILABLE else '🔴 Not Available'}")
+OBSOLETE_REPORT_INDEXES = ("timestamp_-1", "station_1_timestamp_-1", "direction_1_timestamp_1")
+def ensure_indexes():
+    """Creates the indexes backing the today-filtered report queries (no-op if they already exist)."""
+    logger.info("🗂️ Ensuring MongoDB indexes...")
+    try:
+        # Indexes replaced by the ones below, dropped so inserts stop maintaining them:
+        # - timestamp_-1: plain descending index, superseded by the ascending TTL index
+        # - station_1_timestamp_-1: station queries all filter on direction too
+        # - direction_1_timestamp_1: served the direction existence check, which now reads daily_stats
+        existing = reports_collection.index_information()
+        for name in OBSOLETE_REPORT_INDEXES:
+            if name in existing:
+                reports_collection.drop_index(name)
+        # Timestamp-only range queries (all of today's reports); doubles as the TTL index that
+        # purges reports once they are older than REPORT_RETENTION_SECONDS
+        reports_collection.create_index([("timestamp", 1)], expireAfterSeconds=REPORT_RETENTION_SECONDS)
+        # Station view: equality on station and direction, range on timestamp
+        reports_collection.create_index([("station", 1), ("direction", 1), ("timestamp", 1)])
+        # A user's own reports, newest first (delete flow)
+        reports_collection.create_index([("user_id", 1), ("timestamp", -1)])
+        # One counter document per (day, direction, station)
+        stats_collection.create_index([("day", 1), ("direction", 1), ("station", 1)], unique=True)
+        # Past days' counters expire together with their reports
+        stats_collection.create_index([("earliest", 1)], expireAfterSeconds=REPORT_RETENTION_SECONDS)
+        logger.info("✅ MongoDB indexes ready")
+    except errors.PyMongoError as e:
+        logger.error(f"❌ Error creating MongoDB indexes: {e}")
+def migrate_float_timestamps():
+    """One-time conversion of legacy Unix-seconds timestamps to BSON dates (no-op once migrated)."""
+    try:
+        result = reports_collection.update_many(
+            {"timestamp": {"$type": "number"}},
+            [{"$set": {"timestamp": {"$toDate": {"$multiply": ["$timestamp", 1000]}}}}]
+        )
+        if result.modified_count:
+            logger.info(f"🔁 Converted {result.modified_count} legacy float timestamps to BSON dates")
+    except errors.PyMongoError as e:
+        logger.error(f"❌ Error migrating legacy timestamps: {e}")
+def rebuild_daily_stats():
+    """Recomputes today's daily_stats counters from the reports (covers writes made while stats were not maintained)."""
+    try:
+        start_of_day, end_of_day = get_current_day_range_in_algeria()
+        day = get_day_key(start_of_day)
+        pipeline = [
+            {"$match": {"timestamp": {"$gte": start_of_day, "$lt": end_of_day}}},
+            {"$group": {"_id": {"direction": "$direction", "station": "$station"},
+                        "count": {"$sum": 1}, "earliest": {"$min": "$timestamp"}}}
+        ]
+        counters = [
+            {"day": day, "direction": doc["_id"]["direction"], "station": doc["_id"]["station"],
+             "count": doc["count"], "earliest": doc["earliest"]}
+            for doc in reports_collection.aggregate(pipeline)
+        ]
+        stats_collection.delete_many({"day": day})
+        if counters:
+            stats_collection.insert_many(counters)
+        logger.info(f"📊 Rebuilt {len(counters)} daily_stats counters for {day}")
+    except errors.PyMongoError as e:
+        logger.error(f"❌ Error rebuilding daily_stats: {e}")
 
 # --- Helper function to get start and end of current day in Algeria timezone ---
+# Cached per calendar day: {"key": date, "value": (start_of_day, end_of_day)}
+_day_range_cache = {"key": None, "value": None}
 def get_current_day_range_in_algeria():
-    """Calculates the start (inclusive) and end (exclusive) timestamps for the current day in Algeria."""
-    now_algeria = datetime.now(ALGERIA_TZ)
+    """Calculates the start (inclusive) and end (exclusive) datetimes for the current day in Algeria."""
+    today = datetime.now(ALGERIA_TZ).date()
+    if _day_range_cache["key"] == today:
+        return _day_range_cache["value"]
     # Start of today (00:00:00)
-    start_of_day = datetime.combine(now_algeria.date(), dt_time.min).replace(tzinfo=ALGERIA_TZ)
+    start_of_day = datetime.combine(today, dt_time.min, tzinfo=ALGERIA_TZ)
     # Start of tomorrow (00:00:00) - acts as exclusive end for today
-    end_of_day = datetime.combine(now_algeria.date(), dt_time.min).replace(tzinfo=ALGERIA_TZ) + timedelta(days=1)
+    end_of_day = start_of_day + _ONE_DAY
+
+    logger.debug("📅 Calculated current day range: %s to %s", start_of_day, end_of_day)
+    _day_range_cache["key"] = today
+    _day_range_cache["value"] = (start_of_day, end_of_day)
+    return start_of_day, end_of_day
 
-    start_timestamp = start_of_day.timestamp()
-    end_timestamp = end_of_day.timestamp()
+def get_day_key(dt):
+    """Algeria calendar day of a datetime as 'YYYY-MM-DD' (daily_stats key)."""
+    return dt.astimezone(ALGERIA_TZ).date().isoformat()
 
-    logger.info(f"📅 Calculated current day range: {start_of_day} ({start_timestamp}) to {end_of_day} ({end_timestamp})")
-    return start_timestamp, end_timestamp
+# --- Short-lived cache for the today views (coalesces identical callbacks) ---
+VIEW_CACHE_TTL_SECONDS = 15
+_view_cache = {} # key -> (expires_at, value)
+def _view_cache_get(key):
+    entry = _view_cache.get(key)
+    if entry is not None and entry[0] > monotonic():
+        return entry[1]
+    return None
+def _view_cache_put(key, value):
+    _view_cache[key] = (monotonic() + VIEW_CACHE_TTL_SECONDS, value)
+# One lock per key so concurrent misses on the same view run a single query (no dogpile)
+_view_cache_locks = {}
+# Bumped by every invalidation; a load that straddles one must not store its (stale) result.
+# The lock makes "generation unchanged -> store" atomic with respect to invalidation.
+_view_cache_generation = 0
+_view_cache_generation_lock = threading.Lock()
+def _view_cache_fetch(key, load):
+    """Returns the cached value for `key`, or calls `load()` once while other threads wait for its result."""
+    value = _view_cache_get(key)
+    if value is not None:
+        logger.debug("⚡ %s served from cache", key[0])
+        return value
+    with _view_cache_locks.setdefault(key, threading.Lock()):
+        value = _view_cache_get(key)
+        if value is None:
+            generation = _view_cache_generation
+            value = load()
+            with _view_cache_generation_lock:
+                if generation == _view_cache_generation:
+                    _view_cache_put(key, value)
+    return value
+def invalidate_view_cache():
+    """Drops all cached views so a new or deleted report shows up immediately."""
+    global _view_cache_generation
+    with _view_cache_generation_lock:
+        _view_cache_generation += 1
+        _view_cache.clear()
+    # Locks only guard in-flight loads; dropping them here keeps the dict from growing day after day
+    _view_cache_locks.clear()
 
 # --- Modified functions to filter by current day and optionally by direction ---
+# These are blocking PyMongo calls: async handlers run them via asyncio.to_thread.
 
-def get_all_reports_from_db_filtered(direction=None):
-    """Retrieves reports filtered to today's date, optionally filtered by direction."""
-    logger.info(f"📥 Retrieving TODAY'S reports from database (direction filter: {direction})...")
+def get_station_counts_today(direction):
+    """
+    Reads today's per-station report counters for a direction from daily_stats.
+    Returns one dict per station: {'station': str, 'count': int, 'earliest': datetime},
+    ordered by earliest report time (ascending).
+    """
+    logger.debug("📥 Reading TODAY'S station counters (direction: %s)...", direction)
     try:
-        if reports_collection is not None and MONGO_AVAILABLE:
-            start_ts, end_ts = get_current_day_range_in_algeria()
-            query = {"timestamp": {"$gte": start_ts, "$lt": end_ts}}
-            if direction:
-                query["direction"] = direction
-            reports = list(reports_collection.find(query))
-            logger.info(f"📊 Retrieved {len(reports)} reports from database (filtered to today, direction: {direction})")
-            return reports
+        if stats_collection is not None and MONGO_AVAILABLE:
+            start_of_day, end_of_day = get_current_day_range_in_algeria()
+            query = {"day": get_day_key(start_of_day), "direction": direction, "count": {"$gt": 0}}
+            projection = {"_id": 0, "station": 1, "count": 1, "earliest": 1}
+            station_counts = _view_cache_fetch(
+                ("station_counts", start_of_day, direction),
+                lambda: list(stats_collection.find(query, projection).sort("earliest", 1))
+            )
+            logger.debug("📊 Read counters for %d stations (today, direction: %s)", len(station_counts), direction)
+            return station_counts
         else:
-            logger.warning("⚠️ MongoDB collection not available for reading (filtered reports)")
+            logger.warning("⚠️ MongoDB collection not available for reading (station counts)")
             return []
-    except Exception as e:
-        logger.error(f"❌ Error getting filtered reports from MongoDB: {e}")
-        logger.exception(e)
+    except errors.PyMongoError as e:
+        logger.error(f"❌ Error reading station counters from MongoDB: {e}")
         return []
 
-def get_reports_by_station_from_db_filtered(station, direction=None):
-    """Retrieves reports for a specific station, filtered to today's date, optionally filtered by direction."""
-    logger.info(f"📥 Retrieving TODAY'S reports for station: {station} (direction filter: {direction})")
+def get_minute_groups_by_station_today(station, direction=None):
+    """
+    Counts today's reports for a station per minute on the server, optionally filtered by direction.
+    Returns the latest STATION_VIEW_MINUTES groups, newest first:
+    [{'time_str': 'HH:MM' (Algeria time), 'count': int}, ...]
+    """
+    logger.debug("📥 Grouping TODAY'S reports per minute for station: %s (direction filter: %s)", station, direction)
     try:
         if reports_collection is not None and MONGO_AVAILABLE:
-            start_ts, end_ts = get_current_day_range_in_algeria()
-            query = {"station": station, "timestamp": {"$gte": start_ts, "$lt": end_ts}}
+            start_of_day, end_of_day = get_current_day_range_in_algeria()
+            match = {"station": station, "timestamp": {"$gte": start_of_day, "$lt": end_of_day}}
             if direction:
-                 query["direction"] = direction
-            reports = list(reports_collection.find(query))
-            logger.info(f"📊 Retrieved {len(reports)} reports for station {station} (filtered to today, direction: {direction})")
-            return reports
+                match["direction"] = direction
+            pipeline = [
+                {"$match": match}, # Served by the (station, direction, timestamp) index
+                # Bucket by the minute as a Date so the sort compares numbers, not strings (MongoDB 5.0+)
+                {"$group": {"_id": {"$dateTrunc": {"date": "$timestamp", "unit": "minute", "timezone": ALGERIA_TZ.key}},
+                            "count": {"$sum": 1}}},
+                {"$sort": {"_id": -1}}, # Newest minute first
+                {"$limit": STATION_VIEW_MINUTES}, # Only the latest minutes are displayed
+                # Format the display string (HH:MM in Algeria time) only for the surviving buckets
+                {"$project": {"_id": 0, "count": 1,
+                              "time_str": {"$dateToString": {"format": REPORT_TIME_FORMAT, "date": "$_id", "timezone": ALGERIA_TZ.key}}}}
+            ]
+            minute_groups = _view_cache_fetch(
+                ("station_minutes", start_of_day, station, direction),
+                lambda: list(reports_collection.aggregate(pipeline))
+            )
+            logger.debug("📊 Retrieved %d minute groups for station %s (filtered to today, direction: %s)", len(minute_groups), station, direction)
+            return minute_groups
         else:
             logger.warning("⚠️ MongoDB collection not available for reading (filtered station reports)")
             return []
-    except Exception as e:
-        logger.error(f"❌ Error getting filtered reports by station from MongoDB: {e}")
-        logger.exception(e)
+    except errors.PyMongoError as e:
+        logger.error(f"❌ Error grouping reports by station in MongoDB: {e}")
         return []
 
-# --- Helper function to group reports by minute ---
-def group_reports_by_minute(reports):
-    """
-    Groups reports by station, direction, and minute.
-    Returns a list of dictionaries with 'station', 'direction', 'time_str', and 'count'.
-    """
-    logger.info("🔄 Grouping reports by minute...")
-    grouped = {}
-    for report in reports:
-        station = report["station"]
-        direction = report["direction"]
-        # Create a key based on station, direction, and the minute part of the timestamp
-        report_time = datetime.fromtimestamp(report["timestamp"], ALGERIA_TZ)
-        # Truncate seconds to get the minute key
-        minute_key = report_time.replace(second=0, microsecond=0)
-        key = (station, direction, minute_key)
-
-        if key not in grouped:
-            grouped[key] = {
-                "station": station,
-                "direction": direction,
-                "time_str": minute_key.strftime(REPORT_TIME_FORMAT), # Format as HH:MM
-                "count": 0
-            }
-        grouped[key]["count"] += 1
-
-    # Convert the grouped dictionary values to a list and sort by time (newest first for display)
-    result = sorted(grouped.values(), key=lambda x: x['time_str'], reverse=True)
-    logger.info(f"📊 Grouped into {len(result)} entries.")
-    return result
-
-# Function to get all unique stations preserving order from schedules (used for reporting)
+# All unique stations preserving order from schedules (used for reporting).
+# Go stations come first; dict.fromkeys dedupes while keeping insertion order.
+_ALL_STATIONS_ORDERED = tuple(dict.fromkeys([*go_schedule, *return_schedule]))
 def get_all_stations_ordered():
-    logger.info("📋 Getting all stations in order...")
-    go_stations = list(go_schedule.keys())
-    return_stations = list(return_schedule.keys())
-    all_stations = []
-    seen = set()
-    # Add stations from go_schedule first
-    for station in go_stations:
-        if station not in seen:
-            all_stations.append(station)
-            seen.add(station)
-    # Add stations from return_schedule
-    for station in return_stations:
-        if station not in seen:
-            all_stations.append(station)
-            seen.add(station)
-    logger.info(f"📊 Total stations found: {len(all_stations)}")
-    return all_stations
+    return _ALL_STATIONS_ORDERED
+# Buttons carry a station's index into _ALL_STATIONS_ORDERED instead of its Arabic name:
+# short ASCII callback_data, well inside Telegram's 64-byte limit
+STATION_IDS = {station: str(index) for index, station in enumerate(_ALL_STATIONS_ORDERED)}
+def station_from_callback(arg):
+    """Resolves a station id from callback_data; None for malformed or unknown ids."""
+    # isdecimal, not isdigit: isdigit accepts characters such as '²' that int() rejects
+    if arg.isdecimal() and int(arg) < len(_ALL_STATIONS_ORDERED):
+        return _ALL_STATIONS_ORDERED[int(arg)]
+    # Buttons sent before ids were introduced still carry the name
+    return arg if arg in STATION_IDS else None
 def get_algerian_time():
     return datetime.now(ALGERIA_TZ)
-def save_report_to_db(report_data):
-    logger.info(f"💾 Attempting to save report to database: {report_data}")
+def get_algerian_minutes():
+    """Current Algerian time of day as minutes since midnight (the schedule tables' key)."""
+    now = get_algerian_time()
+    return now.hour * 60 + now.minute
+def str_to_minutes(s):
+    """Parses an 'HH:MM' schedule entry into minutes since midnight."""
+    # Fixed-width format, so slicing beats strptime
+    if len(s) != 5 or s[2] != ":":
+        raise ValueError(f"Invalid schedule time {s!r}, expected HH:MM")
+    hour, minute = int(s[:2]), int(s[3:])
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f"Invalid schedule time {s!r}, out of range")
+    return hour * 60 + minute
+# Departure times per station as minutes since midnight, aligned index-for-index with the schedule
+# strings. Schedules are listed in departure order, so these lists are sorted and can be bisected
+# with plain int comparisons.
+GO_SCHEDULE_TIMES = {station: [str_to_minutes(t) for t in times] for station, times in go_schedule.items()}
+RETURN_SCHEDULE_TIMES = {station: [str_to_minutes(t) for t in times] for station, times in return_schedule.items()}
+# Per-direction lookup table for the schedule handlers: {direction: {station: (times, display strings)}}
+STATION_SCHEDULES = {
+    DIRECTION_GO: {station: (GO_SCHEDULE_TIMES[station], times) for station, times in go_schedule.items()},
+    DIRECTION_RETURN: {station: (RETURN_SCHEDULE_TIMES[station], times) for station, times in return_schedule.items()},
+}
+# Shared stand-in for a station with no schedule in the chosen direction
+_NO_SCHEDULE = ((), ())
+def _fill_station_texts(template):
+    """Formats a schedule reply template for every known station: {direction: {station: text}}."""
+    return {
+        direction: {station: template.format(station=station, destination=destination) for station in _ALL_STATIONS_ORDERED}
+        for direction, destination in DESTINATIONS.items()
+    }
+NEXT_TRAIN_PREFIXES = _fill_station_texts(TEXT_NEXT_TRAIN_PREFIX)
+ALL_TRAINS_HEADERS = _fill_station_texts(TEXT_ALL_TRAINS_HEADER)
+NO_TRAINS_TEXTS = _fill_station_texts(TEXT_NO_TRAINS_LEFT)
+def _station_text(texts, template, direction, station):
+    """Prebuilt text for a known station; anything else (e.g. no station picked yet) is formatted on the spot."""
+    text = texts[direction].get(station)
+    if text is None:
+        text = template.format(station=station, destination=DESTINATIONS[direction])
+    return text
+def save_reports_to_db(reports):
+    """
+    Inserts a batch of reports in one round-trip and bumps their daily_stats counters.
+    Returns one entry per report: the ID string, or None if that report was not saved.
+    """
+    logger.debug("💾 Attempting to save %d report(s) to database", len(reports))
+    if reports_collection is None:
+        logger.warning("⚠️ MongoDB collection not available for saving")
+        return [None] * len(reports)
+    # IDs are assigned client-side so each caller knows its ID even if part of the batch fails
+    for report in reports:
+        report["_id"] = ObjectId()
+    failed = set()
     try:
-        if reports_collection is not None:
-            logger.info("📤 Inserting document into MongoDB...")
-            result = reports_collection.insert_one(report_data)
-            logger.info(f"✅ Report saved successfully with ID: {result.inserted_id}")
-            # Return the ID as a string for use in callback_data
-            return str(result.inserted_id)
+        logger.debug("📤 Inserting documents into MongoDB...")
+        if len(reports) == 1:
+            # Lone write: skip the bulk-write machinery
+            reports_collection.insert_one(reports[0])
         else:
-            logger.warning("⚠️ MongoDB collection not available for saving")
-            return None
-    except Exception as e:
-        logger.error(f"❌ Error saving report to MongoDB: {e}")
-        logger.exception(e)
-        return None
+            reports_collection.insert_many(reports, ordered=False)
+    except errors.BulkWriteError as e:
+        failed = {write_error["index"] for write_error in e.details.get("writeErrors", [])}
+        logger.error("❌ %d of %d report(s) failed to save: %s", len(failed), len(reports), e)
+    except errors.PyMongoError as e:
+        logger.error("❌ Error saving reports to MongoDB: %s", e)
+        return [None] * len(reports)
+    saved = [report for i, report in enumerate(reports) if i not in failed]
+    update_daily_stats(saved, 1)
+    invalidate_view_cache()
+    logger.debug("✅ Saved %d report(s)", len(saved))
+    # Return the IDs as strings for use in callback_data
+    return [None if i in failed else str(report["_id"]) for i, report in enumerate(reports)]
+def _daily_stats_key(report):
+    """Filter selecting the daily_stats counter of the report's day/direction/station."""
+    return {"day": get_day_key(report["timestamp"]), "direction": report["direction"], "station": report["station"]}
+def _daily_stats_op(report, delta):
+    """Builds the update adding `delta` to the daily_stats counter of the report's day/direction/station."""
+    update = {"$inc": {"count": delta}}
+    if delta > 0:
+        # 'earliest' only moves backwards here; deletes re-derive it (refresh_daily_earliest)
+        update["$min"] = {"earliest": report["timestamp"]}
+    # Only increments create counters: a decrement on a missing row would leave a negative
+    # counter without 'earliest', which the TTL index never expires
+    return UpdateOne(_daily_stats_key(report), update, upsert=delta > 0)
+def update_daily_stats(reports, delta):
+    """Adds `delta` to the daily_stats counters of each report (one bulk round-trip)."""
+    try:
+        if stats_collection is not None and reports:
+            stats_collection.bulk_write([_daily_stats_op(report, delta) for report in reports], ordered=False)
+    except errors.PyMongoError as e:
+        logger.error("❌ Error updating daily_stats: %s", e)
+def refresh_daily_earliest(report):
+    """After a delete, resets the counter's 'earliest' to the first report still stored for that day/direction/station."""
+    try:
+        if stats_collection is None:
+            return
+        start_of_day = datetime.combine(report["timestamp"].astimezone(ALGERIA_TZ).date(), dt_time.min, tzinfo=ALGERIA_TZ)
+        first = reports_collection.find_one(
+            {
+                "station": report["station"],
+                "direction": report["direction"],
+                "timestamp": {"$gte": start_of_day, "$lt": start_of_day + _ONE_DAY},
+            },
+            {"_id": 0, "timestamp": 1},
+            sort=[("timestamp", 1)]
+        )
+        # No report left: the counter is at 0, hidden from the views, and expires with its old 'earliest'
+        if first is not None:
+            stats_collection.update_one(_daily_stats_key(report), {"$set": {"earliest": first["timestamp"]}})
+    except errors.PyMongoError as e:
+        logger.error("❌ Error refreshing daily_stats earliest time: %s", e)
+
+# --- Report write batching ---
+# Reports arriving within one window are coalesced into a single insert_many
+REPORT_FLUSH_INTERVAL_SECONDS = 0.2
+REPORT_FLUSH_MAX_BATCH = 50
+# (report, future) pairs waiting for the next flush; the flusher is started in post_init
+_pending_reports = None
+_flush_task = None
+# Queued by _stop_report_flusher: everything queued before it is flushed, then the loop exits
+_FLUSH_STOP = object()
+REPORT_FLUSH_SHUTDOWN_TIMEOUT_SECONDS = 10
+def _start_report_flusher():
+    """Starts the background flusher (no-op while it is running); must be called inside the event loop."""
+    global _pending_reports, _flush_task
+    if _pending_reports is None:
+        _pending_reports = asyncio.Queue()
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_flush_reports_loop())
+async def _stop_report_flusher():
+    """Flushes the reports still queued, then stops the flusher (cancelling it if it does not finish in time)."""
+    if _flush_task is None or _flush_task.done():
+        return
+    _pending_reports.put_nowait(_FLUSH_STOP)
+    try:
+        await asyncio.wait_for(_flush_task, REPORT_FLUSH_SHUTDOWN_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.error("❌ Report flusher did not drain within %ss; cancelled", REPORT_FLUSH_SHUTDOWN_TIMEOUT_SECONDS)
+async def save_report_async(report_data):
+    """Queues a report for the next bulk insert and waits for it. Returns the ID string or None."""
+    _start_report_flusher() # Restarts the flusher if it ever died
+    future = asyncio.get_running_loop().create_future()
+    _pending_reports.put_nowait((report_data, future))
+    return await future
+async def _flush_reports_loop():
+    """
+    Collects queued reports for up to REPORT_FLUSH_INTERVAL_SECONDS (or a full batch) and saves them together.
+    A lone report (nothing else queued) is written straight away with no window.
+    """
+    loop = asyncio.get_running_loop()
+    batch = []
+    try:
+        stop = False
+        while not stop:
+            item = await _pending_reports.get()
+            if item is _FLUSH_STOP:
+                break
+            batch = [item]
+            # Only open a batching window when other reports are already waiting
+            if not _pending_reports.empty():
+                deadline = loop.time() + REPORT_FLUSH_INTERVAL_SECONDS
+                while len(batch) < REPORT_FLUSH_MAX_BATCH:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(_pending_reports.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    if item is _FLUSH_STOP:
+                        stop = True
+                        break
+                    batch.append(item)
+            try:
+                report_ids = await asyncio.to_thread(save_reports_to_db, [report for report, _ in batch])
+            except Exception as e:
+                logger.exception("❌ Unexpected error flushing reports: %s", e)
+                report_ids = [None] * len(batch)
+            for (_, future), report_id in zip(batch, report_ids):
+                if not future.done():
+                    future.set_result(report_id)
+    finally:
+        # However the loop ends (stop, cancellation, a bug), no caller may be left waiting forever
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+        while not _pending_reports.empty():
+            item = _pending_reports.get_nowait()
+            if item is not _FLUSH_STOP and not item[1].done():
+                item[1].set_result(None)
+def collect_debug_info():
+    """Blocking MongoDB introspection for /debug: (db_names, collection_names, report_count, sample_reports)."""
+    # Check connection
+    logger.info("🔍 Testing MongoDB connection...")
+    client.admin.command('ping')
+    logger.info("✅ MongoDB connection test successful")
+    # Get database info
+    logger.info("🔍 Getting database information...")
+    db_names = client.list_database_names()
+    logger.info(f"📊 Available databases: {db_names}")
+    collection_names = reports_collection.database.list_collection_names()
+    logger.info(f"📂 Available collections: {collection_names}")
+    # Get report count (collection metadata, no scan)
+    logger.info("🔍 Counting reports...")
+    report_count = reports_collection.estimated_document_count()
+    logger.info(f"📈 Total reports in database: {report_count}")
+    # Get the most recent sample reports, fetching only the fields that get printed
+    logger.info("🔍 Getting sample reports...")
+    sample_reports = list(
+        reports_collection.find({}, {"station": 1, "direction": 1, "time": 1}).sort("timestamp", -1).limit(3)
+    )
+    logger.info(f"📋 Sample reports retrieved: {len(sample_reports)}")
+    return db_names, collection_names, report_count, sample_reports
 # Debug command (remains largely unchanged)
 async def debug_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Debug command to check database status"""
@@ -227,31 +592,14 @@ async def debug_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     try:
         logger.info("🔍 Performing debug checks...")
-        # Check connection
-        logger.info("🔍 Testing MongoDB connection...")
-        client.admin.command('ping')
-        logger.info("✅ MongoDB connection test successful")
-        # Get database info
-        logger.info("🔍 Getting database information...")
-        db_names = client.list_database_names()
-        logger.info(f"📊 Available databases: {db_names}")
-        collection_names = reports_collection.database.list_collection_names()
-        logger.info(f"📂 Available collections: {collection_names}")
-        # Get report count
-        logger.info("🔍 Counting reports...")
-        report_count = reports_collection.count_documents({})
-        logger.info(f"📈 Total reports in database: {report_count}")
-        # Get sample reports
-        logger.info("🔍 Getting sample reports...")
-        sample_reports = list(reports_collection.find().limit(3))
-        logger.info(f"📋 Sample reports retrieved: {len(sample_reports)}")
+        db_names, collection_names, report_count, sample_reports = await asyncio.to_thread(collect_debug_info)
         response = "✅ Database Debug Information:\n"
         response += f"📊 Databases: {db_names}\n"
         response += f"📂 Collections: {collection_names}\n"
         response += f"📈 Total Reports: {report_count}\n"
         if sample_reports:
             response += "📋 Recent Reports:\n"
-            for i, report in enumerate(sample_reports[:3]):
+            for i, report in enumerate(sample_reports):
                 response += f"{i+1}. {report.get('station', 'N/A')} - {report.get('direction', 'N/A')} - {report.get('time', 'N/A')}\n"
         else:
             response += "📭 No reports found\n"
@@ -259,53 +607,142 @@ async def debug_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(response)
         logger.info("✅ Debug command completed successfully")
     except Exception as e:
-        logger.error(f"❌ Debug command error: {e}")
-        logger.exception(e)
+        logger.exception("❌ Debug command error: %s", e)
         await update.message.reply_text(f"❌ Database Error: {str(e)}")
+# Main menu keyboard (static, so it is built once at import)
+START_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🚆 الجزائر الى العفرون", callback_data="direction_go")],
+    [InlineKeyboardButton("🚆 العفرون الى الجزائر", callback_data="direction_return")],
+    [InlineKeyboardButton("📊 إبلاغ بوصول قطار", callback_data="report_train")],
+    [InlineKeyboardButton("📋 عرض التقارير", callback_data="view_reports")],
+    [InlineKeyboardButton("🗣️ تواصل مع آخرين", url="https://t.me/+40I26LKN_0ZjYzY0")]
+])
+# Just the "back to main menu" button
+BACK_MARKUP = InlineKeyboardMarkup([[BACK_BUTTON]])
+# Back to the report menu (used by the reporting and delete flows)
+REPORT_BACK_BUTTON = InlineKeyboardButton(TEXT_BACK, callback_data="report_train")
+REPORT_BACK_MARKUP = InlineKeyboardMarkup([[REPORT_BACK_BUTTON]])
+# Report menu: report a new arrival or delete an existing report
+REPORT_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ إبلاغ بوصول جديد", callback_data="report_new_arrival")],
+    [InlineKeyboardButton("🗑️ حذف تقرير", callback_data="delete_my_reports")],
+    [BACK_BUTTON]
+])
+# Next-train answer: offer the full list of upcoming trains
+NEXT_TRAIN_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("عرض جميع القطارات القادمة", callback_data="show_all_trains")],
+    [BACK_BUTTON]
+])
+# Direction picker for viewing reports
+VIEW_DIRECTION_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"🚆 {DIRECTION_LABELS[DIRECTION_GO]}", callback_data="view_reports_direction_go")],
+    [InlineKeyboardButton(f"🚆 {DIRECTION_LABELS[DIRECTION_RETURN]}", callback_data="view_reports_direction_return")],
+    [BACK_BUTTON]
+])
+# Below a station's reports: back to that direction's station list, or to the main menu
+VIEW_STATION_BACK_MARKUPS = {
+    direction: InlineKeyboardMarkup([
+        [InlineKeyboardButton("📋 عرض محطات أخرى", callback_data=f"view_reports_direction_{direction}")],
+        [BACK_BUTTON]
+    ])
+    for direction in (DIRECTION_GO, DIRECTION_RETURN)
+}
+# Station pickers for the schedule lookup, one per direction (one station per row)
+GO_STATION_MARKUP = InlineKeyboardMarkup([
+    *([InlineKeyboardButton(station, callback_data=f"station_{STATION_IDS[station]}")] for station in go_schedule),
+    [BACK_BUTTON]
+])
+RETURN_STATION_MARKUP = InlineKeyboardMarkup([
+    *([InlineKeyboardButton(station, callback_data=f"station_{STATION_IDS[station]}")] for station in return_schedule),
+    [BACK_BUTTON]
+])
+def _pairs(items):
+    """Groups items two per row for a keyboard; an odd last item gets a row of its own."""
+    it = iter(items)
+    return [[item for item in pair if item is not None] for pair in zip_longest(it, it)]
+# Station picker for reporting: all stations, two per row, back to the report menu
+REPORT_STATION_MARKUP = InlineKeyboardMarkup([
+    *([InlineKeyboardButton(station, callback_data=f"report_station_{STATION_IDS[station]}") for station in pair]
+      for pair in _pairs(get_all_stations_ordered())),
+    [REPORT_BACK_BUTTON]
+])
+# Direction picker shown after a station is chosen for reporting
+REPORT_DIRECTION_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"🚆 {DIRECTION_LABELS[DIRECTION_GO]}", callback_data="report_direction_go")],
+    [InlineKeyboardButton(f"🚆 {DIRECTION_LABELS[DIRECTION_RETURN]}", callback_data="report_direction_return")],
+    [REPORT_BACK_BUTTON]
+])
+class UserState:
+    """Per-user menu state, kept under a single user_data key (fixed slots, no per-instance dict)."""
+    __slots__ = ("direction", "last_station", "report_station", "view_direction")
+    def __init__(self):
+        self.direction = DIRECTION_RETURN # Schedule direction; the return schedule until one is picked (as before)
+        self.last_station = None
+        self.report_station = None
+        self.view_direction = None
+def get_user_state(context):
+    """Returns the caller's UserState, creating it on first use."""
+    state = context.user_data.get("state")
+    if state is None:
+        state = context.user_data["state"] = UserState()
+    return state
+async def _safe_edit(query, text, reply_markup=None):
+    """Edits the callback's message, skipping the API call when text and keyboard are already shown."""
+    message = query.message
+    if message is not None and message.text == text and message.reply_markup == reply_markup:
+        return
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Telegram rejects no-op edits (e.g. a double tap racing the first edit); nothing to do
+        if "not modified" not in str(e):
+            raise
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("🏠 Start command received")
-    keyboard = [
-        [InlineKeyboardButton("🚆 الجزائر الى العفرون", callback_data="direction_go")],
-        [InlineKeyboardButton("🚆 العفرون الى الجزائر", callback_data="direction_return")],
-        [InlineKeyboardButton("📊 إبلاغ بوصول قطار", callback_data="report_train")],
-        [InlineKeyboardButton("📋 عرض التقارير", callback_data="view_reports")],
-        [InlineKeyboardButton("🗣️ تواصل مع آخرين", url="https://t.me/+40I26LKN_0ZjYzY0")]
-    ]
+    logger.debug("🏠 Start command received")
     if update.message:
-        await update.message.reply_text("👋 مرحبًا بك! اختر خيارًا:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await update.message.reply_text(TEXT_WELCOME, reply_markup=START_MARKUP)
     else:
-        await update.callback_query.edit_message_text("👋 مرحبًا بك! اختر خيارًا:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await _safe_edit(update.callback_query, TEXT_WELCOME, START_MARKUP)
 
 # --- Helper functions for user-specific actions (remain unchanged) ---
-def get_reports_by_user_id(user_id):
-    """Get all reports created by a specific user ID"""
-    logger.info(f"📥 Retrieving reports for user ID: {user_id}")
+def get_reports_by_user_id(user_id, limit=USER_REPORTS_LIMIT):
+    """Get the `limit` most recent reports created by a specific user ID (newest first)"""
+    logger.debug("📥 Retrieving reports for user ID: %s", user_id)
     try:
         if reports_collection is not None:
-            reports = list(reports_collection.find({"user_id": str(user_id)}))
-            logger.info(f"📊 Retrieved {len(reports)} reports for user {user_id}")
+            # Only the fields the delete listing renders (_id is kept for callback_data)
+            projection = {"station": 1, "direction": 1, "time": 1, "timestamp": 1}
+            # Sorted and capped server-side via the (user_id, timestamp) index
+            cursor = reports_collection.find({"user_id": str(user_id)}, projection).sort("timestamp", -1).limit(limit)
+            reports = list(cursor)
+            logger.debug("📊 Retrieved %d reports for user %s", len(reports), user_id)
             return reports
         else:
             logger.warning("⚠️ MongoDB collection not available for reading (user reports)")
             return []
-    except Exception as e:
+    except errors.PyMongoError as e:
         logger.error(f"❌ Error getting reports by user ID from MongoDB: {e}")
-        logger.exception(e)
         return []
 
 def delete_report_from_db(report_id):
     """Delete a report by its MongoDB ID"""
-    logger.info(f"🗑️ Attempting to delete report with ID: {report_id}")
+    logger.debug("🗑️ Attempting to delete report with ID: %s", report_id)
     try:
         if reports_collection is not None:
-            from bson import ObjectId
             # Ensure report_id is a valid ObjectId string
             if not ObjectId.is_valid(report_id):
                 logger.error(f"❌ Invalid ObjectId format: {report_id}")
                 return False
-            result = reports_collection.delete_one({"_id": ObjectId(report_id)})
-            if result.deleted_count > 0:
-                logger.info(f"✅ Successfully deleted report with ID: {report_id}")
+            # find_one_and_delete returns the removed report so its counter can be decremented
+            deleted = reports_collection.find_one_and_delete(
+                {"_id": ObjectId(report_id)},
+                projection={"station": 1, "direction": 1, "timestamp": 1}
+            )
+            if deleted is not None:
+                update_daily_stats([deleted], -1)
+                refresh_daily_earliest(deleted)
+                invalidate_view_cache()
+                logger.debug("✅ Successfully deleted report with ID: %s", report_id)
                 return True
             else:
                 logger.warning(f"⚠️ No report found with ID: {report_id}")
@@ -314,358 +751,351 @@ def delete_report_from_db(report_id):
             logger.warning("⚠️ MongoDB collection not available for deletion")
             return False
     except Exception as e:
-        logger.error(f"❌ Error deleting report from MongoDB: {e}")
-        logger.exception(e)
+        logger.exception("❌ Error deleting report from MongoDB: %s", e)
         return False
 
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        query = update.callback_query
-        await query.answer()
-        logger.info(f"🎮 Callback received: {query.data}")
-        user_id = query.from_user.id # Get the user ID who clicked the button
-        data = query.data
-        # --- NEW DELETE REPORT FLOW ---
-        # Handle request to view user's own reports for deletion
-        if data == "delete_my_reports":
-            logger.info(f"🗑️ User {user_id} requested to view their reports for deletion")
-            user_reports = get_reports_by_user_id(user_id)
-            if not user_reports:
-                response = "❌ لم تقم بإنشاء أي تقارير بعد."
-                keyboard = [[InlineKeyboardButton("⬅️ العودة", callback_data="report_train")]]
-                await query.edit_message_text(response, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
-            response = "📋 تقاريرك:\n(انقر على التقرير لحذفه)\n"
-            keyboard = []
-            # Sort by timestamp (newest first) and show last 15
-            sorted_reports = sorted(user_reports, key=lambda x: x["timestamp"], reverse=True)[:15]
-            for i, report in enumerate(sorted_reports):
-                station = report['station']
-                direction_text = "الجزائر الى العفرون" if report["direction"] == DIRECTION_GO else "العفرون الى الجزائر"
-                time_str = report['time'] # This will now be in the new format
-                report_id = str(report['_id'])
-                response += f"{i+1}. {station} | {direction_text} | {time_str}\n"
-                # Button to delete this specific report
-                keyboard.append([InlineKeyboardButton(f"🗑️ حذف {i+1}", callback_data=f"confirm_delete_my_report_{report_id}")])
-            keyboard.append([InlineKeyboardButton("⬅️ العودة", callback_data="report_train")])
-            await query.edit_message_text(response, reply_markup=InlineKeyboardMarkup(keyboard))
-            return
-        # Handle confirmation of deleting a user's own report
-        elif data.startswith("confirm_delete_my_report_"):
-            report_id = data.split("_", 4)[4]
-            logger.info(f"🗑️ User {user_id} confirmed deletion of report {report_id}")
-            success = delete_report_from_db(report_id)
-            if success:
-                response_text = "✅ تم حذف التقرير بنجاح!"
-            else:
-                response_text = "❌ فشل في حذف التقرير. قد يكون التقرير غير موجود."
-            await query.edit_message_text(response_text)
-            # Return to main menu after delay
-            await asyncio.sleep(2)
-            await start(update, context)
-            return
-        # --- END NEW DELETE REPORT FLOW ---
-        # Report Train Arrival - Updated to include delete option
-        if data == "report_train":
-            logger.info("📝 User selected to report train arrival or manage reports")
-            # Present options: report new arrival or delete existing reports
-            keyboard = [
-                [InlineKeyboardButton("➕ إبلاغ بوصول جديد", callback_data="report_new_arrival")],
-                [InlineKeyboardButton("🗑️ حذف تقرير", callback_data="delete_my_reports")],
-                [InlineKeyboardButton("⬅️ العودة", callback_data="back_to_start")]
-            ]
-            await query.edit_message_text("اختر إجراء:", reply_markup=InlineKeyboardMarkup(keyboard))
-            return
-        # Sub-option for reporting a new arrival
-        elif data == "report_new_arrival":
-             logger.info("📝 User selected to report a *new* train arrival")
-             stations = get_all_stations_ordered()
-             logger.info(f"📊 Showing {len(stations)} stations for reporting")
-             station_buttons = []
-             for i in range(0, len(stations), 2):
-                 row = []
-                 row.append(InlineKeyboardButton(stations[i], callback_data=f"report_station_{stations[i]}"))
-                 if i + 1 < len(stations):
-                     row.append(InlineKeyboardButton(stations[i + 1], callback_data=f"report_station_{stations[i + 1]}"))
-                 station_buttons.append(row)
-             station_buttons.append([InlineKeyboardButton("⬅️ العودة", callback_data="report_train")])
-             await query.edit_message_text("📍 اختر المحطة التي وصل إليها القطار:", reply_markup=InlineKeyboardMarkup(station_buttons))
-             return
-        elif data.startswith("report_station_"):
-            station = data.split("_", 2)[2]
-            context.user_data["report_station"] = station
-            logger.info(f"📍 User selected station: {station}")
-            keyboard = [
-                [InlineKeyboardButton("🚆 الجزائر الى العفرون", callback_data="report_direction_go")],
-                [InlineKeyboardButton("🚆 العفرون الى الجزائر", callback_data="report_direction_return")],
-                [InlineKeyboardButton("⬅️ العودة", callback_data="report_train")] # Changed back button
-            ]
-            await query.edit_message_text(f"📍 المحطة: {station}\nاختر اتجاه القطار:", reply_markup=InlineKeyboardMarkup(keyboard))
-            return
-        elif data == "report_direction_go":
-            station = context.user_data.get("report_station")
-            direction = DIRECTION_GO
-            logger.info(f"📤 Saving report - Station: {station}, Direction: {direction}, User: {user_id}")
-            alg_time = get_algerian_time()
-            report = {
-                "station": station,
-                "direction": direction,
-                # --- Use the new time format (Hour:Minute only) ---
-                "time": alg_time.strftime(REPORT_TIME_FORMAT), # Changed from '%Y-%m-%d %H:%M:%S'
-                "timestamp": alg_time.timestamp(), # Keep timestamp for grouping/filtering
-                "user_id": str(user_id) # Store the user ID who created the report
-            }
-            logger.info(f"📝 Report data: {report}")
-            report_id = save_report_to_db(report) # Get the report ID
-            if report_id:
-                response_text = (f"✅ تم حفظ التقرير!\n"
-                                 f"📍 المحطة: {station}\n"
-                                 f"🧭 الاتجاه: الجزائر الى العفرون\n"
-                                 f"🕐 الوقت: {report['time']}")
-                logger.info(f"🎉 Report saved successfully for {station} with ID: {report_id} by user {user_id}")
-            else:
-                response_text = (f"❌ فشل حفظ التقرير!\n"
-                                 f"📍 المحطة: {station}\n"
-                                 f"🧭 الاتجاه: الجزائر الى العفرون\n"
-                                 f"🕐 الوقت: {report['time']}\n"
-                                 f"⚠️ مشكلة في الاتصال بقاعدة البيانات")
-                logger.error(f"💥 Failed to save report for {station}")
-            await query.edit_message_text(response_text)
-            await asyncio.sleep(3)
-            await start(update, context)
-            return
-        elif data == "report_direction_return":
-            station = context.user_data.get("report_station")
-            direction = DIRECTION_RETURN
-            logger.info(f"📤 Saving report - Station: {station}, Direction: {direction}, User: {user_id}")
-            alg_time = get_algerian_time()
-            report = {
-                "station": station,
-                "direction": direction,
-                 # --- Use the new time format (Hour:Minute only) ---
-                "time": alg_time.strftime(REPORT_TIME_FORMAT), # Changed from '%Y-%m-%d %H:%M:%S'
-                "timestamp": alg_time.timestamp(), # Keep timestamp for grouping/filtering
-                "user_id": str(user_id) # Store the user ID who created the report
-            }
-            logger.info(f"📝 Report data: {report}")
-            report_id = save_report_to_db(report) # Get the report ID
-            if report_id:
-                response_text = (f"✅ تم حفظ التقرير!\n"
-                                 f"📍 المحطة: {station}\n"
-                                 f"🧭 الاتجاه: العفرون الى الجزائر\n"
-                                 f"🕐 الوقت: {report['time']}")
-                logger.info(f"🎉 Report saved successfully for {station} with ID: {report_id} by user {user_id}")
-            else:
-                response_text = (f"❌ فشل حفظ التقرير!\n"
-                                 f"📍 المحطة: {station}\n"
-                                 f"🧭 الاتجاه: العفرون الى الجزائر\n"
-                                 f"🕐 الوقت: {report['time']}\n"
-                                 f"⚠️ مشكلة في الاتصال بقاعدة البيانات")
-                logger.error(f"💥 Failed to save report for {station}")
-            await query.edit_message_text(response_text)
-            await asyncio.sleep(3)
-            await start(update, context)
-            return
-        # View Reports - Ask for direction first
-        elif data == "view_reports":
-            logger.info("📋 User requested to view reports - asking for direction first")
-            if not MONGO_AVAILABLE:
-                response = "❌ قاعدة البيانات غير متوفرة حالياً."
-                keyboard = [[InlineKeyboardButton("⬅️ العودة", callback_data="back_to_start")]]
-                await query.edit_message_text(response, reply_markup=InlineKeyboardMarkup(keyboard))
-                logger.warning("⚠️ View reports: MongoDB not available")
-                return
+# --- Callback handlers (one coroutine per button, dispatched from handle_callback) ---
+# --- NEW DELETE REPORT FLOW ---
+async def _handle_delete_my_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle request to view user's own reports for deletion"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    logger.debug("🗑️ User %s requested to view their reports for deletion", user_id)
+    user_reports = await asyncio.to_thread(get_reports_by_user_id, user_id, limit=USER_REPORTS_LIMIT)
+    if not user_reports:
+        response = TEXT_NO_USER_REPORTS
+        await _safe_edit(query, response, REPORT_BACK_MARKUP)
+        return
+    lines = ["📋 تقاريرك:", "(انقر على التقرير لحذفه)"]
+    keyboard = []
+    # Reports arrive newest first, already capped at the last USER_REPORTS_LIMIT
+    for i, report in enumerate(user_reports):
+        station = report['station']
+        direction_text = DIRECTION_LABELS[report["direction"]]
+        time_str = report['time'] # This will now be in the new format
+        report_id = str(report['_id'])
+        lines.append(f"{i+1}. {station} | {direction_text} | {time_str}")
+        # Button to delete this specific report
+        keyboard.append([InlineKeyboardButton(f"🗑️ حذف {i+1}", callback_data=f"confirm_delete_my_report_{report_id}")])
+    keyboard.append([REPORT_BACK_BUTTON])
+    await _safe_edit(query, "\n".join(lines), InlineKeyboardMarkup(keyboard))
 
-            # Ask user to choose direction first
-            keyboard = [
-                [InlineKeyboardButton("🚆 الجزائر الى العفرون", callback_data="view_reports_direction_go")],
-                [InlineKeyboardButton("🚆 العفرون الى الجزائر", callback_data="view_reports_direction_return")],
-                [InlineKeyboardButton("⬅️ العودة", callback_data="back_to_start")]
-            ]
-            await query.edit_message_text("🧭 اختر الاتجاه أولاً لعرض التقارير:", reply_markup=InlineKeyboardMarkup(keyboard))
-            return
+async def _handle_confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, report_id: str):
+    """Handle confirmation of deleting a user's own report"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    logger.debug("🗑️ User %s confirmed deletion of report %s", user_id, report_id)
+    success = await asyncio.to_thread(delete_report_from_db, report_id)
+    if success:
+        response_text = "✅ تم حذف التقرير بنجاح!"
+    else:
+        response_text = "❌ فشل في حذف التقرير. قد يكون التقرير غير موجود."
+    # Show the outcome together with the main menu in a single edit
+    await _safe_edit(query, f"{response_text}\n\n{TEXT_WELCOME}", START_MARKUP)
+# --- END NEW DELETE REPORT FLOW ---
 
-        # Handle direction selection for viewing reports (Sorting by Earliest Report Time)
-        elif data in ["view_reports_direction_go", "view_reports_direction_return"]:
-            chosen_direction = DIRECTION_GO if data == "view_reports_direction_go" else DIRECTION_RETURN
-            context.user_data["view_direction"] = chosen_direction
-            direction_text_display = "الجزائر الى العفرون" if chosen_direction == DIRECTION_GO else "العفرون الى الجزائر"
-            logger.info(f"🧭 User selected direction: {direction_text_display} for viewing reports (sorted by time)")
+async def _handle_report_train(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Report Train Arrival - Updated to include delete option"""
+    query = update.callback_query
+    logger.debug("📝 User selected to report train arrival or manage reports")
+    # Present options: report new arrival or delete existing reports
+    await _safe_edit(query, TEXT_PICK_ACTION, REPORT_MENU_MARKUP)
 
-            # 1. Get today's reports for the specific direction
-            reports_today_direction = get_all_reports_from_db_filtered(direction=chosen_direction)
+async def _handle_report_new_arrival(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Sub-option for reporting a new arrival"""
+    query = update.callback_query
+    logger.debug("📝 User selected to report a *new* train arrival")
+    await _safe_edit(query, TEXT_PICK_REPORT_STATION, REPORT_STATION_MARKUP)
 
-            if not reports_today_direction:
-                response = "❌ لا توجد تقارير محفوظة لهذا اليوم في هذا الاتجاه."
-                keyboard = [[InlineKeyboardButton("⬅️ العودة", callback_data="back_to_start")]]
-                await query.edit_message_text(response, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+async def _handle_report_station(update: Update, context: ContextTypes.DEFAULT_TYPE, station: str):
+    query = update.callback_query
+    get_user_state(context).report_station = station
+    logger.debug("📍 User selected station: %s", station)
+    await _safe_edit(query, f"📍 المحطة: {station}\nاختر اتجاه القطار:", REPORT_DIRECTION_MARKUP)
 
-            # 2. Group reports by station
-            stations_with_reports = {}
-            for report in reports_today_direction:
-                station = report["station"]
-                if station not in stations_with_reports:
-                    stations_with_reports[station] = []
-                stations_with_reports[station].append(report)
-
-            # 3. Find the earliest report timestamp for each station
-            station_earliest_times = {}
-            for station, reports in stations_with_reports.items():
-                # Find the report with the minimum timestamp for this station
-                earliest_report = min(reports, key=lambda r: r['timestamp'])
-                station_earliest_times[station] = earliest_report['timestamp']
-
-            # 4. Sort stations based on their earliest report time (ascending order)
-            sorted_stations_by_time = sorted(station_earliest_times.keys(), key=lambda s: station_earliest_times[s])
-
-            logger.info(f"📊 Found {len(sorted_stations_by_time)} stations with reports for direction {chosen_direction} (sorted by earliest time)")
-
-            # 5. Create station buttons based on the time-sorted list
-            station_buttons = []
-            for i in range(0, len(sorted_stations_by_time), 2):
-                row = []
-                station1 = sorted_stations_by_time[i]
-                report_count1 = len(stations_with_reports[station1])
-                row.append(InlineKeyboardButton(f"📍 {station1} ({report_count1})", callback_data=f"view_station_filtered_{station1}"))
-                if i + 1 < len(sorted_stations_by_time):
-                    station2 = sorted_stations_by_time[i + 1]
-                    report_count2 = len(stations_with_reports[station2])
-                    row.append(InlineKeyboardButton(f"📍 {station2} ({report_count2})", callback_data=f"view_station_filtered_{station2}"))
-                station_buttons.append(row)
-            station_buttons.append([InlineKeyboardButton("⬅️ العودة", callback_data="back_to_start")])
-
-            await query.edit_message_text(f"📋 اختر محطة لعرض تقارير اليوم ({direction_text_display}) مرتبة حسب وقت التقرير:", reply_markup=InlineKeyboardMarkup(station_buttons))
-            return
+async def _save_report_in_background(query, report):
+    """Persist a report after the optimistic confirmation; roll the message back on failure."""
+    station = report["station"]
+    report_id = await save_report_async(report) # Get the report ID
+    if report_id:
+        logger.debug("🎉 Report saved successfully for %s with ID: %s by user %s", station, report_id, report["user_id"])
+        return
+    logger.error("💥 Failed to save report for %s", station)
+    response_text = (f"❌ فشل حفظ التقرير!\n"
+                     f"📍 المحطة: {station}\n"
+                     f"🧭 الاتجاه: {DIRECTION_LABELS[report['direction']]}\n"
+                     f"🕐 الوقت: {report['time']}\n"
+                     f"⚠️ مشكلة في الاتصال بقاعدة البيانات")
+    await _safe_edit(query, f"{response_text}\n\n{TEXT_WELCOME}", START_MARKUP)
 
-        # View Station Reports (Filtered by previously selected direction)
-        elif data.startswith("view_station_filtered_"):
-            selected_station = data.split("_", 3)[3]
-            chosen_direction = context.user_data.get("view_direction")
-            logger.info(f"🔍 User viewing TODAY'S reports for station: {selected_station} in direction: {chosen_direction}")
-
-            if not chosen_direction:
-                 logger.warning("⚠️ View station filtered: No direction selected in user_data")
-                 await query.edit_message_text("❌ حدث خطأ. يرجى المحاولة مرة أخرى من البداية.")
-                 return
-
-            if not MONGO_AVAILABLE:
-                response = "❌ قاعدة البيانات غير متوفرة حالياً."
-                keyboard = [[InlineKeyboardButton("⬅️ العودة", callback_data="back_to_start")]]
-                await query.edit_message_text(response, reply_markup=InlineKeyboardMarkup(keyboard))
-                return
+async def _handle_report_direction(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Save a report for the chosen direction and confirm immediately"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    station = get_user_state(context).report_station
+    direction = DIRECTION_GO if query.data == "report_direction_go" else DIRECTION_RETURN
+    logger.debug("📤 Saving report - Station: %s, Direction: %s, User: %s", station, direction, user_id)
+    alg_time = get_algerian_time()
+    report = {
+        "station": station,
+        "direction": direction,
+        # --- Use the new time format (Hour:Minute only) ---
+        "time": alg_time.strftime(REPORT_TIME_FORMAT), # Changed from '%Y-%m-%d %H:%M:%S'
+        "timestamp": alg_time, # Stored as a BSON date for grouping/filtering
+        "user_id": str(user_id) # Store the user ID who created the report
+    }
+    logger.debug("📝 Report data: %s", report)
+    response_text = (f"✅ تم حفظ التقرير!\n"
+                     f"📍 المحطة: {station}\n"
+                     f"🧭 الاتجاه: {DIRECTION_LABELS[direction]}\n"
+                     f"🕐 الوقت: {report['time']}")
+    # Optimistic confirmation together with the main menu in a single edit;
+    # the insert runs afterwards so a failure edit can never be overwritten by it
+    await _safe_edit(query, f"{response_text}\n\n{TEXT_WELCOME}", START_MARKUP)
+    context.application.create_task(_save_report_in_background(query, report), update=update)
 
-            # Get filtered reports for the station AND the chosen direction for TODAY
-            station_reports_raw = get_reports_by_station_from_db_filtered(station=selected_station, direction=chosen_direction)
+async def _handle_view_reports(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """View Reports - Ask for direction first"""
+    query = update.callback_query
+    logger.debug("📋 User requested to view reports - asking for direction first")
+    if not MONGO_AVAILABLE:
+        response = TEXT_DB_UNAVAILABLE
+        await _safe_edit(query, response, BACK_MARKUP)
+        logger.warning("⚠️ View reports: MongoDB not available")
+        return
 
-            if not station_reports_raw:
-                direction_text_display = "الجزائر الى العفرون" if chosen_direction == DIRECTION_GO else "العفرون الى الجزائر"
-                response = f"❌ لا توجد تقارير لهذا اليوم للمحطة: {selected_station} في اتجاه {direction_text_display}"
-            else:
-                # Group the raw reports by minute
-                grouped_reports_list = group_reports_by_minute(station_reports_raw)
-
-                if not grouped_reports_list:
-                     response = f"❌ لا توجد تقارير لهذا اليوم للمحطة: {selected_station} في هذا الاتجاه (بعد التجميع)"
-                else:
-                    direction_text_header = "الجزائر الى العفرون" if chosen_direction == DIRECTION_GO else "العفرون الى الجزائر"
-                    response = f"📋 تقارير اليوم للمحطة: {selected_station} ({direction_text_header})\n"
-                    # Show last 10 grouped entries (already sorted by time, newest first)
-                    for i, grouped_report in enumerate(grouped_reports_list[:10]):
-                        # Note: Direction is already filtered, so no need to check again
-                        time_str = grouped_report['time_str']
-                        count = grouped_report['count']
-                        # Add checkmark and count if more than one
-                        count_display = f" ✅ ({count})" if count > 1 else ""
-                        response += f"{i+1}. 🕐 {time_str}{count_display}\n"
-
-            # Update back button logic to go back to direction selection
-            keyboard = [
-                [InlineKeyboardButton("📋 عرض محطات أخرى", callback_data=f"view_reports_direction_{chosen_direction}")], # Go back to station list for the same direction
-                [InlineKeyboardButton("⬅️ العودة", callback_data="back_to_start")]
-            ]
-            await query.edit_message_text(response, reply_markup=InlineKeyboardMarkup(keyboard))
-            return
-        # Original functionality (remains unchanged)
-        elif data == "direction_go":
-            context.user_data["direction"] = DIRECTION_GO
-            stations = list(go_schedule.keys())
-            station_buttons = [
-                [InlineKeyboardButton(station, callback_data=f"station_{station}")]
-                for station in stations
-            ]
-            station_buttons.append([InlineKeyboardButton("⬅️ العودة", callback_data="back_to_start")])
-            await query.edit_message_text("📍 اختر محطتك:", reply_markup=InlineKeyboardMarkup(station_buttons))
-            return
-        elif data == "direction_return":
-            context.user_data["direction"] = DIRECTION_RETURN
-            stations = list(return_schedule.keys())
-            station_buttons = [
-                [InlineKeyboardButton(station, callback_data=f"station_{station}")]
-                for station in stations
-            ]
-            station_buttons.append([InlineKeyboardButton("⬅️ العودة", callback_data="back_to_start")])
-            await query.edit_message_text("📍 اختر محطتك:", reply_markup=InlineKeyboardMarkup(station_buttons))
-            return
-        elif data == "back_to_start":
-            await start(update, context)
-            return
-        elif data == "show_all_trains":
-            station = context.user_data.get("last_station")
-            direction = context.user_data.get("direction")
-            if direction == DIRECTION_GO:
-                schedule = go_schedule.get(station, [])
-                destination = "العفرون"
-            else:
-                schedule = return_schedule.get(station, [])
-                destination = "الجزائر"
-            now = get_algerian_time().time()
-            def str_to_time(s):
-                return datetime.strptime(s, "%H:%M").time()
-            future_trains = [t for t in schedule if str_to_time(t) > now]
-            if future_trains:
-                train_list = "\n".join([f"🚆 {time}" for time in future_trains])
-                response = f"جميع القطارات القادمة من {station} إلى {destination}:\n{train_list}"
-            else:
-                response = f"❌ لا يوجد قطارات متبقية اليوم من {station} إلى {destination}."
-            keyboard = [[InlineKeyboardButton("⬅️ العودة", callback_data="back_to_start")]]
-            await query.edit_message_text(text=response, reply_markup=InlineKeyboardMarkup(keyboard))
-            return
-        elif data.startswith("station_"):
-            station = data.split("_", 1)[1]
-            context.user_data["last_station"] = station
-            direction = context.user_data.get("direction")
-            now = get_algerian_time().time()
-            def str_to_time(s):
-                return datetime.strptime(s, "%H:%M").time()
-            if direction == DIRECTION_GO:
-                schedule = go_schedule.get(station, [])
-                destination = "العفرون"
-            else:
-                schedule = return_schedule.get(station, [])
-                destination = "الجزائر"
-            next_train = next((t for t in schedule if str_to_time(t) > now), None)
-            if next_train:
-                response = f"🚉 القطار الآتي من {station} إلى {destination} ينطلق على الساعة {next_train}."
-                keyboard = [
-                    [InlineKeyboardButton("عرض جميع القطارات القادمة", callback_data="show_all_trains")],
-                    [InlineKeyboardButton("⬅️ العودة", callback_data="back_to_start")]
-                ]
-            else:
-                response = f"❌ لا يوجد قطارات متبقية اليوم من {station} إلى {destination}."
-                keyboard = [[InlineKeyboardButton("⬅️ العودة", callback_data="back_to_start")]]
-            await query.edit_message_text(text=response, reply_markup=InlineKeyboardMarkup(keyboard))
-            return
-        else:
-            await query.edit_message_text("❗ أمر غير معروف.")
-            return
-    except Exception as e:
-        logger.error(f"❌ Error in callback handler: {e}")
-        logger.exception(e)
+    # Ask user to choose direction first
+    await _safe_edit(query, TEXT_PICK_VIEW_DIRECTION, VIEW_DIRECTION_MARKUP)
+
+async def _handle_view_reports_direction(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle direction selection for viewing reports (Sorting by Earliest Report Time)"""
+    query = update.callback_query
+    chosen_direction = DIRECTION_GO if query.data == "view_reports_direction_go" else DIRECTION_RETURN
+    get_user_state(context).view_direction = chosen_direction
+    direction_text_display = DIRECTION_LABELS[chosen_direction]
+    logger.debug("🧭 User selected direction: %s for viewing reports (sorted by time)", direction_text_display)
+
+    # 1. Read today's per-station counters for the specific direction (empty list on an empty day)
+    station_counts = await asyncio.to_thread(get_station_counts_today, direction=chosen_direction)
+    # Buttons carry station ids: a counter for a station missing from the schedules can't get a working one
+    unknown = [doc["station"] for doc in station_counts if doc["station"] not in STATION_IDS]
+    if unknown:
+        logger.warning("⚠️ Skipping report counters for unknown stations: %s", unknown)
+        station_counts = [doc for doc in station_counts if doc["station"] in STATION_IDS]
+
+    if not station_counts:
+        response = TEXT_NO_REPORTS_TODAY
+        await _safe_edit(query, response, BACK_MARKUP)
+        return
+
+    # 2. Stations already come back sorted by their earliest report time (ascending order)
+    logger.debug("📊 Found %d stations with reports for direction %s (sorted by earliest time)", len(station_counts), chosen_direction)
+
+    # 3. Create station buttons based on the time-sorted list, two per row
+    station_buttons = [
+        [InlineKeyboardButton(f"📍 {doc['station']} ({doc['count']})", callback_data=f"view_station_filtered_{STATION_IDS[doc['station']]}") for doc in pair]
+        for pair in _pairs(station_counts)
+    ]
+    station_buttons.append([BACK_BUTTON])
+
+    await _safe_edit(query, f"📋 اختر محطة لعرض تقارير اليوم ({direction_text_display}) مرتبة حسب وقت التقرير:", InlineKeyboardMarkup(station_buttons))
+
+async def _handle_view_station_filtered(update: Update, context: ContextTypes.DEFAULT_TYPE, selected_station: str):
+    """View Station Reports (Filtered by previously selected direction)"""
+    query = update.callback_query
+    chosen_direction = get_user_state(context).view_direction
+    logger.debug("🔍 User viewing TODAY'S reports for station: %s in direction: %s", selected_station, chosen_direction)
+
+    if not chosen_direction:
+         logger.warning("⚠️ View station filtered: No direction selected in user_data")
+         await _safe_edit(query, "❌ حدث خطأ. يرجى المحاولة مرة أخرى من البداية.")
+         return
+
+    if not MONGO_AVAILABLE:
+        response = TEXT_DB_UNAVAILABLE
+        await _safe_edit(query, response, BACK_MARKUP)
+        return
+
+    # Get per-minute counts for the station AND the chosen direction for TODAY (grouped server-side)
+    minute_groups = await asyncio.to_thread(get_minute_groups_by_station_today, station=selected_station, direction=chosen_direction)
+
+    if not minute_groups:
+        direction_text_display = DIRECTION_LABELS[chosen_direction]
+        response = f"❌ لا توجد تقارير لهذا اليوم للمحطة: {selected_station} في اتجاه {direction_text_display}"
+    else:
+        # Latest STATION_VIEW_MINUTES grouped entries (already sorted and capped server-side, newest first)
+        direction_text_header = DIRECTION_LABELS[chosen_direction]
+        lines = [f"📋 تقارير اليوم للمحطة: {selected_station} ({direction_text_header})"]
+        for i, minute_group in enumerate(minute_groups):
+            time_str = minute_group['time_str']
+            count = minute_group['count']
+            # Add checkmark and count if more than one
+            count_display = f" ✅ ({count})" if count > 1 else ""
+            lines.append(f"{i+1}. 🕐 {time_str}{count_display}")
+        response = "\n".join(lines)
+
+    # Go back to the station list for the same direction, or to the main menu
+    await _safe_edit(query, response, VIEW_STATION_BACK_MARKUPS[chosen_direction])
+
+# Original functionality (remains unchanged)
+async def _handle_direction_go(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    get_user_state(context).direction = DIRECTION_GO
+    await _safe_edit(query, TEXT_PICK_STATION, GO_STATION_MARKUP)
+
+async def _handle_direction_return(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    get_user_state(context).direction = DIRECTION_RETURN
+    await _safe_edit(query, TEXT_PICK_STATION, RETURN_STATION_MARKUP)
+
+@lru_cache(maxsize=1024)
+def _all_trains_text(direction, station, now_minutes):
+    """Upcoming-trains reply for a station at a given minute (schedules are static, so the result is too)."""
+    schedule_times, schedule = STATION_SCHEDULES[direction].get(station, _NO_SCHEDULE)
+    future_trains = schedule[bisect_right(schedule_times, now_minutes):]
+    if future_trains:
+        train_list = "\n".join([f"🚆 {time}" for time in future_trains])
+        return _station_text(ALL_TRAINS_HEADERS, TEXT_ALL_TRAINS_HEADER, direction, station) + train_list
+    return _station_text(NO_TRAINS_TEXTS, TEXT_NO_TRAINS_LEFT, direction, station)
+
+async def _handle_show_all_trains(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    state = get_user_state(context)
+    station, direction = state.last_station, state.direction
+    response = _all_trains_text(direction, station, get_algerian_minutes())
+    await _safe_edit(query, response, BACK_MARKUP)
+
+async def _handle_station(update: Update, context: ContextTypes.DEFAULT_TYPE, station: str):
+    query = update.callback_query
+    state = get_user_state(context)
+    state.last_station = station
+    direction = state.direction
+    now = get_algerian_minutes()
+    schedule_times, schedule = STATION_SCHEDULES[direction].get(station, _NO_SCHEDULE)
+    next_index = bisect_right(schedule_times, now)
+    next_train = schedule[next_index] if next_index < len(schedule) else None
+    if next_train:
+        response = _station_text(NEXT_TRAIN_PREFIXES, TEXT_NEXT_TRAIN_PREFIX, direction, station) + next_train + "."
+        markup = NEXT_TRAIN_MARKUP
+    else:
+        response = _station_text(NO_TRAINS_TEXTS, TEXT_NO_TRAINS_LEFT, direction, station)
+        markup = BACK_MARKUP
+    await _safe_edit(query, response, markup)
+
+# Exact callback_data -> handler (one dict lookup per callback)
+_EXACT_HANDLERS = {
+    "delete_my_reports": _handle_delete_my_reports,
+    "report_train": _handle_report_train,
+    "report_new_arrival": _handle_report_new_arrival,
+    "report_direction_go": _handle_report_direction,
+    "report_direction_return": _handle_report_direction,
+    "view_reports": _handle_view_reports,
+    "view_reports_direction_go": _handle_view_reports_direction,
+    "view_reports_direction_return": _handle_view_reports_direction,
+    "direction_go": _handle_direction_go,
+    "direction_return": _handle_direction_return,
+    "back_to_start": start,
+    "show_all_trains": _handle_show_all_trains,
+}
+# callback_data prefixes that carry an argument (station id or report ID): (prefix, handler, parse).
+# parse turns the text after the prefix into the handler's third argument (None = unknown command).
+# Ordered by how often they are tapped (schedule lookups first); no prefix is a prefix of another.
+_PREFIX_HANDLERS = (
+    ("station_", _handle_station, station_from_callback),
+    ("view_station_filtered_", _handle_view_station_filtered, station_from_callback),
+    ("report_station_", _handle_report_station, station_from_callback),
+    ("confirm_delete_my_report_", _handle_confirm_delete, str),
+)
+
+async def _answer_quietly(query):
+    """Acknowledges a button press; a failed ack (e.g. "query is too old" after a restart) is only logged."""
+    try:
+        await query.answer()
+    except TelegramError as e:
+        logger.warning("⚠️ Could not answer callback query: %s", e)
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # No try/except here: failures propagate to handle_error, registered on the Application
+    query = update.callback_query
+    # Nothing depends on the answer's result: let it run alongside the handler's edit.
+    # No update= here: a failed ack must not reach handle_error, which would overwrite the
+    # handler's own reply with the generic error text.
+    context.application.create_task(_answer_quietly(query))
+    logger.debug("🎮 Callback received: %s", query.data)
+    data = query.data
+    handler = _EXACT_HANDLERS.get(data)
+    if handler is not None:
+        await handler(update, context)
+        return
+    for prefix, handler, parse in _PREFIX_HANDLERS:
+        if data.startswith(prefix):
+            arg = parse(data[len(prefix):])
+            if arg is not None:
+                await handler(update, context, arg)
+                return
+            break
+    await _safe_edit(query, TEXT_UNKNOWN_COMMAND)
+async def handle_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Logs a failed update once and, for button presses, replaces the message with the generic error text."""
+    logger.error("❌ Error while handling an update", exc_info=context.error)
+    if isinstance(update, Update) and update.callback_query is not None:
+        try:
+            await update.callback_query.edit_message_text(TEXT_GENERIC_ERROR)
+        except TelegramError as e:
+            logger.warning("⚠️ Could not show the error message: %s", e)
+# Background startup stats task; module-level so it is neither garbage-collected nor persisted
+_startup_stats_task = None
+def _log_db_stats():
+    """Logs the number of stored reports (blocking; runs in a worker thread)."""
+    if MONGO_AVAILABLE and reports_collection is not None:
         try:
-            await update.callback_query.edit_message_text("❌ حدث خطأ، يرجى المحاولة مرة أخرى.")
-        except:
-            pass
+            # Metadata-based count: O(1) regardless of collection size (exactness not needed for a log line)
+            count = reports_collection.estimated_document_count()
+            logger.info(f"📈 Current reports in database: {count}")
+        except errors.PyMongoError as e:
+            logger.error(f"❌ Error counting documents at startup: {e}")
+async def _post_init(application):
+    """Connects to MongoDB once the event loop runs, then starts the DB introspection in the background."""
+    global MONGO_AVAILABLE, _startup_stats_task
+    # Initialize MongoDB on startup (blocking driver calls run in a worker thread)
+    logger.info("🚀 Initializing MongoDB connection...")
+    MONGO_AVAILABLE = await asyncio.to_thread(init_mongodb)
+    logger.info(f"📊 MongoDB Status: {'🟢 Available' if MONGO_AVAILABLE else '🔴 Not Available'}")
+    _start_report_flusher()
+    # Not application.create_task: PTB only tracks tasks once the application is running,
+    # which post_init precedes; _post_shutdown awaits this one instead
+    _startup_stats_task = asyncio.create_task(asyncio.to_thread(_log_db_stats))
+async def _post_shutdown(application):
+    """Writes out reports still waiting for a flush and finishes the startup stats task before the loop closes."""
+    await _stop_report_flusher()
+    if _startup_stats_task is not None:
+        try:
+            await _startup_stats_task
+        except Exception as e:
+            logger.exception("❌ Startup stats task failed: %s", e)
+def _build_app(token):
+    """Builds the Application and registers its handlers."""
+    app = (
+        ApplicationBuilder()
+        .token(token)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        # Outbound replies/edits get their own pool so they never wait behind long polling
+        .connection_pool_size(64)
+        .pool_timeout(10.0)
+        .connect_timeout(5.0)
+        .read_timeout(10.0)
+        # getUpdates holds its connection for the whole long-poll; keep it in a small separate pool
+        .get_updates_connection_pool_size(4)
+        .get_updates_pool_timeout(60.0)
+        # Handle callbacks from different chats concurrently (no head-of-line blocking)
+        .concurrent_updates(True)
+        .build()
+    )
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("debug", debug_db))
+    app.add_handler(CallbackQueryHandler(handle_callback))
+    app.add_error_handler(handle_error)
+    return app
 def main():
     logger.info("🚀 Starting Train Schedule Bot...")
     token = os.getenv("BOT_TOKEN")
@@ -673,22 +1103,11 @@ def main():
         logger.error("❌ BOT_TOKEN not set in environment variables.")
         return
     try:
-        logger.info(f"📊 MongoDB Status at startup: {'🟢 Available' if MONGO_AVAILABLE else '🔴 Not Available'}")
-        if MONGO_AVAILABLE and reports_collection is not None:
-            try:
-                count = reports_collection.count_documents({})
-                logger.info(f"📈 Current reports in database: {count}")
-            except Exception as e:
-                logger.error(f"❌ Error counting documents at startup: {e}")
-        app = ApplicationBuilder().token(token).build()
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(CommandHandler("debug", debug_db))
-        app.add_handler(CallbackQueryHandler(handle_callback))
+        app = _build_app(token)
         logger.info("✅ Train Schedule Bot is running with Algeria timezone and MongoDB...")
         app.run_polling()
-    except Exception as e:
-        logger.error(f"❌ Bot failed to start: {e}")
-        logger.exception(e)
+    except Exception:
+        logger.exception("❌ Bot failed to start")
         raise
 if __name__ == '__main__':
     main()